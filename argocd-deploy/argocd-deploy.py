@@ -1,36 +1,228 @@
+# pylint: disable=too-many-lines
+import difflib
+import functools
 import os
 import sh
+import shlex
 import sys
+import tempfile
 import re
+import random
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 from io import StringIO
 import yaml
-from pathlib import Path
 
+try:
+    from ruamel.yaml import YAML, YAMLError
+    # round trip loader/dumper that keeps quoting and layout, and does not fold long lines
+    YAML_RT = YAML()
+    YAML_RT.preserve_quotes = True
+    YAML_RT.indent(mapping=2, sequence=4, offset=2)
+    YAML_RT.width = 4096
+except ImportError:
+    YAML_RT = None
 
-GIT_REPO_REGEX = re.compile(r"(?P<protocol>^https:\/\/|^http:\/\/)?(?P<address>.*$)")
+
+@functools.lru_cache(maxsize=None)
+def _git():
+    """git, resolved on PATH on first use rather than on import, run without a pseudo-terminal.
+    """
+    return sh.Command('git').bake(
+        # protocol v2 lists only the refs asked for
+        '-c', 'protocol.version=2',
+        _tty_out=False
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _argocd():
+    """argocd, resolved on PATH on first use rather than on import, run without a pseudo-terminal.
+    """
+    return sh.Command('argocd').bake(_tty_out=False)
+
+
+YQ_SIMPLE_PATH_REGEX = re.compile(r"^(\.[\w-]+)+$")
+# a document start marker (---), after any leading blank or comment lines
+YAML_EXPLICIT_START_REGEX = re.compile(r"^(?:[ \t]*(?:#.*)?\n)*---(?:\s|$)")
+# a key on its own line, then the first entry of the block sequence under it,
+# to tell how far the file indents the dash and the entry from the key
+YAML_BLOCK_SEQUENCE_INDENT_REGEX = re.compile(
+    r"^( *)[^\s#-][^\n]*:[ \t]*(?:#.*)?\n(?:[ \t]*(?:#.*)?\n)*( *)- +(?=\S)",
+    re.MULTILINE
+)
 ARGOCD_OP_IN_PROGRESS_REGEX = re.compile(
-    r'.*FailedPrecondition.*another\s+operation\s+is\s+already\s+in\s+progress',
+    r'FailedPrecondition.*another\s+operation\s+is\s+already\s+in\s+progress',
     re.DOTALL
 )
 ARGOCD_HEALTH_STATE_TRANSITIONED_FROM_HEALTHY_TO_DEGRADED = re.compile(
-    r".*level=fatal.*health\s+state\s+has\s+transitioned\s+from\s.+\s+to\s+Degraded",
+    r"level=fatal.*health\s+state\s+has\s+transitioned\s+from\s.+\s+to\s+Degraded",
     re.DOTALL
 )
 MAX_ATTEMPT_TO_WAIT_FOR_ARGOCD_OP_RETRIES = 2
 MAX_ATTEMPT_TO_WAIT_FOR_ARGOCD_HEALTH_RETRIES = 2
+# the errors looked for in argocd output are reported at the end of it,
+# so only this many of the last characters of the output are kept to search
+ARGOCD_OUTPUT_TAIL_MAX_SIZE = 64 * 1024
+# exponential backoff, with up to ARGOCD_SYNC_RETRY_BACKOFF_JITTER_SECONDS of random jitter,
+# before retrying a sync that failed because of another operation in progress
+ARGOCD_SYNC_RETRY_BACKOFF_BASE_SECONDS = 1.0
+ARGOCD_SYNC_RETRY_BACKOFF_MAX_SECONDS = 8.0
+ARGOCD_SYNC_RETRY_BACKOFF_JITTER_SECONDS = 0.5
+
+# suffix of the credentials file for the git `store` helper
+GIT_CREDENTIALS_FILE_SUFFIX = '.git-credentials'
+
+# use the libyaml C bindings for parsing when PyYAML was built with them
+YAML_SAFE_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)  # pylint: disable=invalid-name
+
+
+class StepRunnerException(RuntimeError):
+    """Raised when a step of the deployment fails, reported back as an unsuccessful result.
+    """
 
 
-def create_working_dir_sub_dir(work_dir_path, sub_dir_relative_path=""):
-    """Create a folder under the working/stepname folder.
+# git credential helpers, keep in sync with their copies in yq-git/task.py
+@functools.lru_cache(maxsize=None)
+def _git_credentials_dir():
+    """Private (0700) temporary directory for the git credentials file, on the pod's own
+    storage rather than next to the clone, where the workspace may be a persistent volume.
+    """
+    return tempfile.mkdtemp(prefix='git-credentials-')
+
+
+def _git_credentials_file_path(repo_dir):
+    return os.path.join(
+        _git_credentials_dir(),
+        os.path.basename(os.path.abspath(repo_dir)) + GIT_CREDENTIALS_FILE_SUFFIX
+    )
+
+
+def _git_credentials_command(repo_dir, repo_url, username, password):
+    """Returns the git command to run so that it uses the given username and
+    password for an http(s) git repository, by way of git's `store` credential helper
+    reading them from a file in a private temporary directory.
+
+    Keeps the credentials out of the repository URL, where they would otherwise end up in
+    the arguments of every git process, in git's output and in the clone's remote config.
+    The credential helper is configured with `-c` options of only the returned git command,
+    in place of any helpers from the git config files, which are left untouched.
+    Remove the file with `_remove_git_credentials` once done.
+
+    Returns
+    -------
+    sh.Command
+        Git command to run, or `_git()` as is if no credentials are given or the repository
+        is not accessed over http(s).
+    """
+    repo_url_parts = urllib.parse.urlsplit(repo_url)
+    if not (username and password and repo_url_parts.scheme in ('http', 'https')):
+        return _git()
+
+    # the store helper matches on protocol and host, quote the credentials so `@`/`:` stay in them
+    repo_host = repo_url_parts.netloc.rpartition('@')[2]
+    credentials_file_path = _git_credentials_file_path(repo_dir)
+    credentials_file_descriptor = os.open(
+        credentials_file_path,
+        os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+        0o600
+    )
+    with os.fdopen(credentials_file_descriptor, 'w', encoding='utf-8') as credentials_file:
+        credentials_file.write(
+            f"{repo_url_parts.scheme}://{urllib.parse.quote(username, safe='')}"
+            f":{urllib.parse.quote(password, safe='')}@{repo_host}\n"
+        )
+
+    # an empty credential.helper clears any configured before it, and never prompt for input
+    return _git().bake(
+        '-c', 'credential.helper=',
+        '-c', f'credential.helper=store --file={shlex.quote(credentials_file_path)}',
+        _env={**os.environ, 'GIT_TERMINAL_PROMPT': '0'}
+    )
+
+
+def _remove_git_credentials(repo_dir):
+    """Removes the file written by `_git_credentials_command` for the given repository directory,
+    if there is one.
+    """
+    try:
+        os.remove(_git_credentials_file_path(repo_dir))
+    except FileNotFoundError:
+        pass
+
+
+# clone helpers, keep in sync with their copies in yq-git/task.py
+def _update_existing_clone(  # pylint: disable=too-many-arguments
+        git,
+        repo_dir,
+        repo_url,
+        repo_branch,
+        git_email,
+        git_name,
+        sparse_checkout_dirs=None
+):
+    """Updates an existing clone of the deployment configuration repository to the tip of
+    the given branch, fetching just that tip rather than cloning the repository again.
 
     Returns
     -------
     str
-        Path to created working sub directory.
+        Path to the directory of the updated clone.
+
+    Raises
+    ------
+    StepRunnerException
+        If error updating the existing clone.
     """
-    file_path = os.path.join(work_dir_path, sub_dir_relative_path)
-    os.makedirs(file_path, exist_ok=True)
-    return file_path
+    # update origin/<branch> too, or create the branch from the default branch if there is none
+    try:
+        try:
+            git.fetch(  # pylint: disable=no-member
+                '--depth=1',
+                '--no-tags',
+                repo_url,
+                f'+refs/heads/{repo_branch}:refs/remotes/origin/{repo_branch}',
+                _cwd=repo_dir,
+                _out=sys.stdout
+            )
+            checkout_flags = ['-B', repo_branch, f'refs/remotes/origin/{repo_branch}']
+        except sh.ErrorReturnCode as error:
+            if b"couldn't find remote ref" not in error.stderr:
+                raise
+            git.fetch(  # pylint: disable=no-member
+                '--depth=1',
+                '--no-tags',
+                repo_url,
+                'HEAD',
+                _cwd=repo_dir,
+                _fg=True
+            )
+            checkout_flags = ['--no-track', '-B', repo_branch, 'FETCH_HEAD']
+
+        if sparse_checkout_dirs is not None:
+            git(  # pylint: disable=not-callable
+                'sparse-checkout', 'set', '--cone',
+                *[sparse_dir for sparse_dir in sparse_checkout_dirs if sparse_dir],
+                _cwd=repo_dir,
+                _fg=True
+            )
+        git.checkout(  # pylint: disable=no-member
+            '--force',
+            *checkout_flags,
+            _cwd=repo_dir,
+            _fg=True
+        )
+        git.config('user.email', git_email, _cwd=repo_dir)  # pylint: disable=no-member
+        git.config('user.name', git_name, _cwd=repo_dir)  # pylint: disable=no-member
+    except sh.ErrorReturnCode as error:
+        raise StepRunnerException(
+            f"Error updating existing clone of repository ({repo_url})"
+            f" in directory ({repo_dir}): {error}"
+        ) from error
+
+    return repo_dir
 
 
 def clone_repo( # pylint: disable=too-many-arguments
@@ -40,7 +232,8 @@ def clone_repo( # pylint: disable=too-many-arguments
     git_email,
     git_name,
     username=None,
-    password=None
+    password=None,
+    sparse_checkout_dirs=None
 ):
     """Clones and checks out the deployment configuration repository.
 
@@ -54,6 +247,10 @@ def clone_repo( # pylint: disable=too-many-arguments
         email to use when performing git operations in the cloned repository
     git_name : str
         name to use when performing git operations in the cloned repository
+    sparse_checkout_dirs : list of str, optional
+        Directories of the repository to check out, relative to its root, along with the
+        files in its root. If not given the whole repository is checked out.
+        Needs git 2.35 or later, for `git sparse-checkout set --cone`.
 
     Returns
     -------
@@ -66,76 +263,91 @@ def clone_repo( # pylint: disable=too-many-arguments
     StepRunnerException
     * if error cloning repository
     * if error checking out branch of repository
-    * if error configuring repo user
     """
-    repo_match = GIT_REPO_REGEX.match(repo_url)
-    repo_protocol = repo_match.groupdict()['protocol']
-    repo_address = repo_match.groupdict()['address']
-    # if deployment config repo uses http/https push using user/pass
-    # else push using ssh
-    if username and password and repo_protocol and re.match(
-            r'^http://|^https://',
-            repo_protocol
-    ):
-        repo_url_with_auth = \
-            f"{repo_protocol}{username}:{password}" \
-            f"@{repo_address}"
-    else:
-        repo_url_with_auth = repo_url
+    # if deployment config repo uses http/https clone using user/pass
+    # else clone using ssh
+    git = _git_credentials_command(repo_dir, repo_url, username, password)
+
+    if os.path.isdir(os.path.join(repo_dir, '.git')):
+        # reuse the clone left in repo_dir by a previous run (eg: on a persistent workspace)
+        return _update_existing_clone(
+            git=git,
+            repo_dir=repo_dir,
+            repo_url=repo_url,
+            repo_branch=repo_branch,
+            git_email=git_email,
+            git_name=git_name,
+            sparse_checkout_dirs=sparse_checkout_dirs
+        )
+
+    # clone just the tip of the branch, or of the default branch if the branch is new
     try:
-        sh.git.clone( # pylint: disable=no-member
-            repo_url_with_auth,
-            repo_dir,
-            _out=sys.stdout,
+        remote_branch_exists = bool(str(git(  # pylint: disable=not-callable
+            'ls-remote',
+            '--heads',
+            repo_url,
+            f'refs/heads/{repo_branch}',
             _err=sys.stderr
-        )
+        )).strip())
     except sh.ErrorReturnCode as error:
-        raise f"Error cloning repository ({repo_url}): {error}"
+        raise StepRunnerException(
+            f"Error listing branches of repository ({repo_url}): {error}"
+        ) from error
+
+    clone_flags = ['--depth=1', '--single-branch', '--no-tags']
+    if remote_branch_exists:
+        clone_flags += ['--branch', repo_branch]
+    if sparse_checkout_dirs is not None:
+        # fetch only the blobs that are checked out, once the sparse checkout is configured
+        clone_flags += ['--filter=blob:none', '--no-checkout', '--sparse']
 
     try:
-        # no atomic way in git to checkout out new or existing branch,
-        # so first try to check out existing, if that doesn't work try new
+        git.clone(  # pylint: disable=no-member
+            *clone_flags,
+            # set the commit identity as part of the clone
+            '--config', f'user.email={git_email}',
+            '--config', f'user.name={git_name}',
+            repo_url,
+            repo_dir,
+            # git writes its progress straight to the inherited stdout/stderr
+            _fg=True
+        )
+    except sh.ErrorReturnCode as error:
+        raise StepRunnerException(f"Error cloning repository ({repo_url}): {error}") from error
+
+    if sparse_checkout_dirs is not None:
         try:
-            sh.git.checkout(  # pylint: disable=no-member
-                repo_branch,
+            git(  # pylint: disable=not-callable
+                'sparse-checkout', 'set', '--cone',
+                *[sparse_dir for sparse_dir in sparse_checkout_dirs if sparse_dir],
+                _cwd=repo_dir,
+                _fg=True
+            )
+            # unlike `checkout -b`, this also populates the so far empty working tree
+            git.checkout(  # pylint: disable=no-member
+                '-B', repo_branch,
+                'HEAD',
                 _cwd=repo_dir,
-                _out=sys.stdout,
-                _err=sys.stderr
+                _fg=True
             )
-        except sh.ErrorReturnCode:
-            sh.git.checkout(
+        except sh.ErrorReturnCode as error:
+            raise StepRunnerException(
+                f"Error checking out ({sparse_checkout_dirs}) of branch ({repo_branch})"
+                f" from repository ({repo_url}): {error}"
+            ) from error
+    elif not remote_branch_exists:
+        try:
+            git.checkout(  # pylint: disable=no-member
                 '-b',
                 repo_branch,
                 _cwd=repo_dir,
-                _out=sys.stdout,
-                _err=sys.stderr
+                _fg=True
             )
-    except sh.ErrorReturnCode as error:
-        # NOTE: this should never happen
-        raise f"Unexpected error checking out new or existing branch ({repo_branch}) from repository ({repo_url}): {error}"
-
-    try:
-        sh.git.config( # pylint: disable=no-member
-            'user.email',
-            git_email,
-            _cwd=repo_dir,
-            _out=sys.stdout,
-            _err=sys.stderr
-        )
-        sh.git.config( # pylint: disable=no-member
-            'user.name',
-            git_name,
-            _cwd=repo_dir,
-            _out=sys.stdout,
-            _err=sys.stderr
-        )
-    except sh.ErrorReturnCode as error:
-        # NOTE: this should never happen
-        raise (
-            f"Unexpected error configuring git user.email ({git_email})"
-            f" and user.name ({git_name}) for repository ({repo_url})"
-            f" in directory ({repo_dir}): {error}"
-        )
+        except sh.ErrorReturnCode as error:
+            # NOTE: this should never happen
+            raise StepRunnerException(
+                f"Unexpected error checking out new branch ({repo_branch}) from repository ({repo_url}): {error}"
+            ) from error
 
     return repo_dir
 
@@ -147,30 +359,115 @@ def write_working_file(work_dir_path, filename, contents=None):
     ----------
     filename : str
         File name to create
-    contents : str, optional
+    contents : bytes, optional
         Contents to write to the file
 
     Returns
     -------
     str
         Return a string to the file path
+
+    Raises
+    ------
+    StepRunnerException
+        If error writing the file.
     """
     # eg: step-runner-working/step_name
     file_path = os.path.join(work_dir_path, filename)
 
-    # sub-directories might be passed filename, eg: foo/filename
-    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    # write the contents with a single unbuffered write, or touch the file
+    open_flags = os.O_WRONLY | os.O_CREAT | os.O_CLOEXEC
+    if contents is not None:
+        open_flags |= os.O_TRUNC
+    try:
+        # sub-directories might be passed filename, eg: foo/filename
+        file_dir_path = os.path.dirname(file_path)
+        if file_dir_path:
+            os.makedirs(file_dir_path, exist_ok=True)
 
-    if contents is None:
-        Path(file_path).touch()
-    else:
-        with open(file_path, 'wb') as file:
-            file.write(contents)
+        file_descriptor = os.open(file_path, open_flags, 0o644)
+        try:
+            if contents is None:
+                os.utime(file_descriptor)
+            else:
+                # os.write may write less than it is given, so keep going until it is all written
+                contents_view = memoryview(contents)
+                while contents_view:
+                    contents_view = contents_view[os.write(file_descriptor, contents_view):]
+        finally:
+            os.close(file_descriptor)
+    except OSError as error:
+        raise StepRunnerException(f"Error writing working file ({file_path}): {error}") from error
     return file_path
 
 
-def _update_yaml_file_value(work_dir_path, file, yq_path, value):
-    """Update a YAML file using YQ.
+# YAML update and git commit/push helpers, keep in sync with yq-git/task.py
+def _yaml_round_trip_only_changed_target(original_yaml, updated_yaml):
+    """Whether re-dumping a YAML document changed (or removed) at most one of its original lines,
+    any number of lines may be added.
+    """
+    # keep the line endings, so that a line whose ending changed counts as changed
+    original_lines = original_yaml.splitlines(keepends=True)
+    updated_lines = updated_yaml.splitlines(keepends=True)
+    changed_original_line_count = sum(
+        original_end - original_start
+        for tag, original_start, original_end, _, _ in difflib.SequenceMatcher(
+            None, original_lines, updated_lines, autojunk=False
+        ).get_opcodes()
+        if tag in ('replace', 'delete')
+    )
+    return changed_original_line_count <= 1
+
+
+def _read_yaml_file(file):
+    """Reads the contents of a YAML file, as bytes.
+
+    Raises
+    ------
+    StepRunnerException
+        If error reading file.
+    """
+    try:
+        with open(file, 'rb') as stream:
+            return stream.read()
+    except OSError as error:
+        raise StepRunnerException(f"Error reading YAML file ({file}): {error}") from error
+
+
+def _yaml_block_sequence_indent(yaml_str):
+    """Guesses the block sequence indentation of a YAML document, as ruamel.yaml `indent`
+    arguments, defaulting to indented sequences if the document has no block sequences.
+    """
+    match = YAML_BLOCK_SEQUENCE_INDENT_REGEX.search(yaml_str)
+    if match is None:
+        return {'sequence': 4, 'offset': 2}
+
+    key_indent = len(match.group(1))
+    return {
+        'sequence': match.end() - match.start(2) - key_indent,
+        'offset': len(match.group(2)) - key_indent
+    }
+
+
+def _yaml_round_trip_dump(data, original_yaml):
+    """Dumps YAML loaded from `original_yaml` back out, in the same layout and line endings.
+    """
+    # ruamel.yaml is given, and dumps, \n line endings, any CRLF ones are put back after
+    lf_yaml = original_yaml.replace('\r\n', '\n')
+    YAML_RT.explicit_start = YAML_EXPLICIT_START_REGEX.match(lf_yaml) is not None
+    YAML_RT.indent(mapping=2, **_yaml_block_sequence_indent(lf_yaml))
+    updated_yaml_stream = StringIO()
+    YAML_RT.dump(data, updated_yaml_stream)
+    updated_yaml = updated_yaml_stream.getvalue()
+    if not lf_yaml.endswith('\n'):
+        updated_yaml = updated_yaml.rstrip('\n')
+    if lf_yaml != original_yaml:
+        updated_yaml = updated_yaml.replace('\n', '\r\n')
+    return updated_yaml
+
+
+def _update_yaml_file_value(file, yq_path, value):
+    """Update a YAML file value, in process where possible, else using YQ.
 
     Parameters
     ----------
@@ -183,18 +480,59 @@ def _update_yaml_file_value(work_dir_path, file, yq_path, value):
 
     Returns
     -------
-    str
-        Path to the file to update.
+    bool
+        False if the value was already set to `value` and so the file was left as is,
+        True otherwise.
 
     Raises
     ------
     StepRunnerException
         If error updating file.
     """
-    # NOTE: use a YQ script to update so that comment can be injected
-    # TODO: update to YQ 4 and drop script file (and associated python parameters)
+    original_contents = _read_yaml_file(file)
 
-    # inplace update the file
+    # update simple paths (eg: .image.tag) in process, else fall back to yq
+    if YAML_RT is not None and YQ_SIMPLE_PATH_REGEX.match(yq_path):
+        try:
+            original_yaml = original_contents.decode('utf-8')
+        except UnicodeDecodeError as error:
+            raise StepRunnerException(f"Error reading YAML file ({file}): {error}") from error
+        try:
+            data = YAML_RT.load(original_yaml.replace('\r\n', '\n'))
+        except YAMLError:
+            # eg: more than one document in the file, leave it to yq
+            data = None
+
+        *parent_keys, leaf_key = yq_path[1:].split('.')
+        parent = data
+        for key in parent_keys:
+            if not isinstance(parent, dict):
+                break
+            # create missing (or empty) parent mappings, as `yq '.a.b = "c"'` does
+            if parent.get(key) is None:
+                parent[key] = type(parent)()
+            parent = parent[key]
+
+        if isinstance(parent, dict):
+            if parent.get(leaf_key) == value:
+                return False
+
+            parent[leaf_key] = value
+            updated_yaml = _yaml_round_trip_dump(data, original_yaml)
+
+            # leave it to yq if the round trip re-formatted anything but the target line
+            if _yaml_round_trip_only_changed_target(original_yaml, updated_yaml):
+                try:
+                    with open(file, 'w', encoding='utf-8', newline='') as stream:
+                        stream.write(updated_yaml)
+                except OSError as error:
+                    raise StepRunnerException(
+                        f"Error writing YAML file ({file}): {error}"
+                    ) from error
+                return True
+
+    # inplace update the file using yq,
+    # comparing the contents either side of it to tell whether anything changed
     try:
         sh.yq.eval( # pylint: disable=no-member
             f'{yq_path} = "{value}"',
@@ -202,93 +540,88 @@ def _update_yaml_file_value(work_dir_path, file, yq_path, value):
             '--inplace'
         )
     except sh.ErrorReturnCode as error:
-        raise (
+        raise StepRunnerException(
             f"Error updating YAML file ({file}) target ({yq_path}) with value ({value}):"
             f" {error}"
-        )
+        ) from error
 
-    return file
+    return _read_yaml_file(file) != original_contents
 
 
 def _git_commit_file(git_commit_message, file_path, repo_dir):
     try:
-        sh.git.add( # pylint: disable=no-member
-            file_path,
-            _cwd=repo_dir,
-            _out=sys.stdout,
-            _err=sys.stderr
-        )
-    except sh.ErrorReturnCode as error:
-        # NOTE: this should never happen
-        raise (
-            f"Unexpected error adding file ({file_path}) to commit"
-            f" in git repository ({repo_dir}): {error}"
-        )
-
-    try:
-        sh.git.commit( # pylint: disable=no-member
-            '--allow-empty',
-            '--all',
+        _git().commit( # pylint: disable=no-member
             '--message', git_commit_message,
+            # giving the path stages it, so no separate `git add` is needed
+            '--',
+            file_path,
             _cwd=repo_dir,
-            _out=sys.stdout,
-            _err=sys.stderr
+            _fg=True
         )
     except sh.ErrorReturnCode as error:
         # NOTE: this should never happen
-        raise RuntimeError(
+        raise StepRunnerException(
             f"Unexpected error commiting file ({file_path})"
             f" in git repository ({repo_dir}): {error}"
         ) from error
 
 
-def _git_push(repo_dir, url=None):
+def _git_push(repo_dir, branch, url=None, git=None):
     """
-    Raises string if error pushing commits
+    Raises StepRunnerException if error pushing commits
     """
 
-    git_push = sh.git.push.bake(url) if url else sh.git.push
-
-    # push commits
+    # push only the given branch using an explicit refspec, so that git does not need to
+    # work out what to push from push.default and upstream tracking configuration,
+    # which also covers branches that were created locally and do not exist upstream yet.
+    # the push is of a generated commit, so don't run any pre-push hook left in a reused clone
     try:
-        git_push(
+        (git or _git()).push(  # pylint: disable=no-member
+            '--no-verify',
+            url or 'origin',
+            f'HEAD:refs/heads/{branch}',
             _cwd=repo_dir,
-            _out=sys.stdout
+            _fg=True
+        )
+        # pushing by URL leaves origin/<branch> as it was, so move it to what was just pushed,
+        # else a reused clone would report the branch as ahead of it until the next fetch
+        (git or _git())(  # pylint: disable=not-callable
+            'update-ref',
+            f'refs/remotes/origin/{branch}',
+            'HEAD',
+            _cwd=repo_dir
         )
     except sh.ErrorReturnCode as error:
-        raise (
+        raise StepRunnerException(
             f"Error pushing commits from repository directory ({repo_dir}) to"
             f" repository ({url}): {error}"
-        )
+        ) from error
 
 
 def _git_push_deployment_config_repo(
         deployment_config_repo,
         deployment_config_repo_dir,
+        branch,
         username,
         password
 ):
-    deployment_config_repo_match = GIT_REPO_REGEX.match(deployment_config_repo)
-    deployment_config_repo_protocol = deployment_config_repo_match.groupdict()['protocol']
-    deployment_config_repo_address = deployment_config_repo_match.groupdict()['address']
-
     # if deployment config repo uses http/https push using user/pass
     # else push using ssh
-    if deployment_config_repo_protocol and re.match(
-            r'^http://|^https://',
-            deployment_config_repo_protocol
-    ):
-        deployment_config_repo_with_user_pass = \
-            f"{deployment_config_repo_protocol}{username}:{password}" \
-            f"@{deployment_config_repo_address}"
+    # remove the credentials once pushed
+    try:
         _git_push(
             repo_dir=deployment_config_repo_dir,
-            url=deployment_config_repo_with_user_pass
-        )
-    else:
-        _git_push(
-            repo_dir=deployment_config_repo_dir
+            branch=branch,
+            url=deployment_config_repo,
+            git=_git_credentials_command(
+                deployment_config_repo_dir,
+                deployment_config_repo,
+                username,
+                password
+            )
         )
+    finally:
+        _remove_git_credentials(deployment_config_repo_dir)
 
 
 def _argocd_sign_in(
@@ -309,16 +642,18 @@ def _argocd_sign_in(
         if insecure:
             insecure_flag = '--insecure'
 
-        sh.argocd.login(  # pylint: disable=no-member
+        _argocd().login(  # pylint: disable=no-member
             argocd_api,
             f'--username={username}',
             f'--password={password}',
             insecure_flag,
+            # NOTE: not _fg, this runs on a worker thread alongside the git commands, and sh
+            #       serialises every _fg command behind one process wide lock until it exits
             _out=sys.stdout,
             _err=sys.stderr
         )
     except sh.ErrorReturnCode as error:
-        raise f"Error logging in to ArgoCD: {error}"
+        raise StepRunnerException(f"Error logging in to ArgoCD: {error}") from error
 
 
 def _argocd_app_create_or_update( # pylint: disable=too-many-arguments
@@ -351,7 +686,7 @@ def _argocd_app_create_or_update( # pylint: disable=too-many-arguments
             for value_file in values_files:
                 values_params += [f'--values={value_file}']
 
-        sh.argocd.app.create(  # pylint: disable=no-member
+        _argocd().app.create(  # pylint: disable=no-member
             argocd_app_name,
             f'--repo={repo}',
             f'--revision={revision}',
@@ -366,7 +701,9 @@ def _argocd_app_create_or_update( # pylint: disable=too-many-arguments
             _err=sys.stderr
         )
     except sh.ErrorReturnCode as error:
-        raise f"Error creating or updating ArgoCD app ({argocd_app_name}): {error}"
+        raise StepRunnerException(
+            f"Error creating or updating ArgoCD app ({argocd_app_name}): {error}"
+        ) from error
 
 
 def _argocd_app_wait_for_operation(argocd_app_name, argocd_timeout_seconds):
@@ -388,7 +725,7 @@ def _argocd_app_wait_for_operation(argocd_app_name, argocd_timeout_seconds):
         print(
             f"Wait for existing ArgoCD operations on Application ({argocd_app_name})"
         )
-        sh.argocd.app.wait( # pylint: disable=no-member
+        _argocd().app.wait( # pylint: disable=no-member
             argocd_app_name,
             '--operation',
             '--timeout', argocd_timeout_seconds,
@@ -396,10 +733,37 @@ def _argocd_app_wait_for_operation(argocd_app_name, argocd_timeout_seconds):
             _err=sys.stderr
         )
     except sh.ErrorReturnCode as error:
-        raise (
+        raise StepRunnerException(
             f"Error waiting for existing ArgoCD operations on Application ({argocd_app_name})"
             f": {error}"
-        )
+        ) from error
+
+
+class OutputTailBuffer:
+    """Text stream that only keeps (at least) the last `max_size` characters written to it.
+
+    Used in place of a StringIO to capture command output that is only searched for errors
+    reported at the end of it, so that long running commands do not buffer all of their output.
+    """
+
+    def __init__(self, max_size=ARGOCD_OUTPUT_TAIL_MAX_SIZE):
+        self.__max_size = max_size
+        self.__chunks = deque()
+        self.__size = 0
+
+    def write(self, data):
+        """Appends the given data, dropping the oldest data no longer needed for the tail."""
+        self.__chunks.append(data)
+        self.__size += len(data)
+        while self.__size - len(self.__chunks[0]) >= self.__max_size:
+            self.__size -= len(self.__chunks.popleft())
+
+    def flush(self):
+        """Nothing to flush, present so this can be written to like any other stream."""
+
+    def getvalue(self):
+        """Returns the kept tail of the data written."""
+        return ''.join(self.__chunks)
 
 
 def create_sh_redirect_to_multiple_streams_fn_callback(streams):
@@ -460,7 +824,7 @@ def _argocd_app_wait_for_health(argocd_app_name, argocd_timeout_seconds):
         state.
     """
     for wait_for_health_retry in range(MAX_ATTEMPT_TO_WAIT_FOR_ARGOCD_OP_RETRIES):
-        argocd_output_buff = StringIO()
+        argocd_output_buff = OutputTailBuffer()
         try:
             print(f"Wait for Healthy ArgoCD Application ({argocd_app_name}")
             out_callback = create_sh_redirect_to_multiple_streams_fn_callback([
@@ -471,7 +835,7 @@ def _argocd_app_wait_for_health(argocd_app_name, argocd_timeout_seconds):
                 sys.stderr,
                 argocd_output_buff
             ])
-            sh.argocd.app.wait(  # pylint: disable=no-member
+            _argocd().app.wait(  # pylint: disable=no-member
                 argocd_app_name,
                 '--health',
                 '--timeout', argocd_timeout_seconds,
@@ -489,8 +853,7 @@ def _argocd_app_wait_for_health(argocd_app_name, argocd_timeout_seconds):
             #       HorizontalPodAutoscaller doesn't enter Degraded state until after we are
             #       already waiting for the ArgoCD Application to enter Healthy state,
             #       but then the HorizontalPodAutoscaller will, after a time, become Healthy.
-            if re.match(
-                    ARGOCD_HEALTH_STATE_TRANSITIONED_FROM_HEALTHY_TO_DEGRADED,
+            if ARGOCD_HEALTH_STATE_TRANSITIONED_FROM_HEALTHY_TO_DEGRADED.search(
                     argocd_output_buff.getvalue()
             ):
                 print(
@@ -501,7 +864,9 @@ def _argocd_app_wait_for_health(argocd_app_name, argocd_timeout_seconds):
                     " wait for Healthy state."
                 )
             else:
-                raise f"Error waiting for Healthy ArgoCD Application ({argocd_app_name}): {error}"
+                raise StepRunnerException(
+                    f"Error waiting for Healthy ArgoCD Application ({argocd_app_name}): {error}"
+                ) from error
 
 
 def _argocd_app_sync(
@@ -527,7 +892,7 @@ def _argocd_app_sync(
         )
 
         # sync app
-        argocd_output_buff = StringIO()
+        argocd_output_buff = OutputTailBuffer()
         try:
             print(f"Request synchronization of ArgoCD app ({argocd_app_name}).")
             out_callback = create_sh_redirect_to_multiple_streams_fn_callback([
@@ -539,7 +904,7 @@ def _argocd_app_sync(
                 argocd_output_buff
             ])
 
-            sh.argocd.app.sync(  # pylint: disable=no-member
+            _argocd().app.sync(  # pylint: disable=no-member
                 *argocd_sync_additional_flags,
                 '--timeout', argocd_sync_timeout_seconds,
                 '--retry-limit', argocd_sync_retry_limit,
@@ -557,7 +922,7 @@ def _argocd_app_sync(
             #       we try to do a sync
             #
             # SEE: https://github.com/argoproj/argo-cd/issues/4505
-            if re.match(ARGOCD_OP_IN_PROGRESS_REGEX, argocd_output_buff.getvalue()):
+            if ARGOCD_OP_IN_PROGRESS_REGEX.search(argocd_output_buff.getvalue()):
                 print(
                     f"ArgoCD Application ({argocd_app_name}) has an existing operation"
                     " that started after we already waited for existing operations but"
@@ -566,6 +931,16 @@ def _argocd_app_sync(
                     f" {MAX_ATTEMPT_TO_WAIT_FOR_ARGOCD_OP_RETRIES}) again to"
                     " wait for the operation"
                 )
+
+                # give the other operation time to finish rather than immediately
+                # waiting on it and syncing again, unless there are no tries left
+                if wait_for_op_retry + 1 < MAX_ATTEMPT_TO_WAIT_FOR_ARGOCD_OP_RETRIES:
+                    time.sleep(
+                        min(
+                            ARGOCD_SYNC_RETRY_BACKOFF_MAX_SECONDS,
+                            ARGOCD_SYNC_RETRY_BACKOFF_BASE_SECONDS * (2 ** wait_for_op_retry)
+                        ) + random.uniform(0, ARGOCD_SYNC_RETRY_BACKOFF_JITTER_SECONDS)
+                    )
                 continue
 
             if not argocd_sync_prune:
@@ -578,10 +953,10 @@ def _argocd_app_sync(
             else:
                 prune_warning = ""
 
-            raise (
+            raise StepRunnerException(
                 f"Error synchronization ArgoCD Application ({argocd_app_name})"
                 f"{prune_warning}: {error}"
-            )
+            ) from error
 
     # wait for sync to finish
     _argocd_app_wait_for_health(
@@ -590,9 +965,78 @@ def _argocd_app_sync(
     )
 
 
-def _get_deployed_host_urls( # pylint: disable=too-many-branches,too-many-nested-blocks
-        manifest_path
-):
+def _load_host_resources(stream):
+    """Yields the Route and Ingress resources from a stream of Kubernetes resource documents.
+
+    Only the documents whose top level `kind` is one of `HOST_RESOURCE_KINDS` are constructed
+    into Python objects, every other document (Deployments, ConfigMaps, Secrets, etc), which is
+    most of a typical manifest, is skipped once it has been parsed.
+    """
+    manifest_loader = YAML_SAFE_LOADER(stream)
+    try:
+        while manifest_loader.check_node():
+            manifest_node = manifest_loader.get_node()
+            if not isinstance(manifest_node, yaml.MappingNode):
+                continue
+
+            kind = next(
+                (
+                    value_node.value for key_node, value_node in manifest_node.value
+                    if key_node.value == 'kind' and isinstance(value_node, yaml.ScalarNode)
+                ),
+                None
+            )
+            if kind in HOST_RESOURCE_KINDS:
+                yield manifest_loader.construct_document(manifest_node)
+    finally:
+        manifest_loader.dispose()
+
+
+def _get_route_host_urls(route):
+    """Gets the host URL of a route.openshift.io/v1/Route, https if the Route has TLS config.
+    """
+    route_spec = route.get('spec') or {}
+    host = route_spec.get('host')
+    if not host:
+        return []
+
+    protocol = 'https://' if route_spec.get('tls') else 'http://'
+    return [f"{protocol}{host}"]
+
+
+def _get_ingress_host_urls(ingress):
+    """Gets the host URLs of the rules of a networking.k8s.io/v1/Ingress,
+    https for the hosts listed in the Ingress' TLS config.
+    """
+    ingress_spec = ingress.get('spec') or {}
+
+    # collect the TLS hosts once rather than searching the TLS config for every rule
+    tls_hosts = {
+        tls_host
+        for tls_config in ingress_spec.get('tls') or []
+        for tls_host in tls_config.get('hosts') or []
+    }
+
+    host_urls = []
+    for rule in ingress_spec.get('rules') or []:
+        host = rule.get('host')
+        if host:
+            protocol = 'https://' if host in tls_hosts else 'http://'
+            host_urls.append(f"{protocol}{host}")
+
+    return host_urls
+
+
+# functions to get the host URLs from each supported kind and apiVersion of Kubernetes resource
+HOST_URL_RESOURCE_HANDLERS = {
+    ('Route', 'route.openshift.io/v1'): _get_route_host_urls,
+    ('Ingress', 'networking.k8s.io/v1'): _get_ingress_host_urls
+}
+# kinds of Kubernetes resources that deployed host URLs are read from
+HOST_RESOURCE_KINDS = frozenset(kind for kind, _ in HOST_URL_RESOURCE_HANDLERS)
+
+
+def _get_deployed_host_urls(manifest_path):
     """Gets the ingress hosts URLs from a manifest of Kubernetes resources.
 
     Supports:
@@ -605,80 +1049,38 @@ def _get_deployed_host_urls( # pylint: disable=too-many-branches,too-many-nested
     list of str
         Ingress hosts URLs defined in the given manifest of Kubernetes resources.
 
+    Raises
+    ------
+    StepRunnerException
+        If error reading or parsing the manifest.
+
     See
     ---
     * https://docs.openshift.com/container-platform/4.6/rest_api/network_apis/ingress-networking-k8s-io-v1.html
     * https://docs.openshift.com/container-platform/4.6/rest_api/network_apis/route-route-openshift-io-v1.html
     """ # pylint: disable=line-too-long
     host_urls = []
-    manifest_resources = {}
     # load the manifest
-    with open(manifest_path, encoding='utf-8') as file:
-        manifest_resources = yaml.load_all(file, Loader=yaml.FullLoader)
-
-        # for each resource in the manfest,
-        # determine if its a known type and then attempt to get host and TLS config from it
-        for manifest_resource in manifest_resources:
-            if manifest_resource is None or 'kind' not in manifest_resource:
-                continue
-
-            kind = manifest_resource['kind']
-            api_version = manifest_resource['apiVersion']
-
-            # if Route resource
-            if kind == 'Route' and api_version == 'route.openshift.io/v1':
-                # get host
-                if 'host' in manifest_resource['spec']:
-                    host = manifest_resource['spec']['host']
-
-                    # determine if TLS route
-                    tls = False
-                    if 'tls' in manifest_resource['spec']:
-                        tls_config = manifest_resource['spec']['tls']
-                        if tls_config:
-                            tls = True
-
-                    # determine protocol
-                    protocol = ''
-                    if tls:
-                        protocol = 'https://'
-                    else:
-                        protocol = 'http://'
-
-                    # record the host url
-                    host_urls.append(f"{protocol}{host}")
-
-            # if Ingress resource
-            if kind == 'Ingress' and api_version == 'networking.k8s.io/v1':
-                ingress_rules = manifest_resource['spec']['rules']
-                for rule in ingress_rules:
-                    # get host
-                    if 'host' in rule:
-                        host = rule['host']
-
-                        # determine if TLS ingress
-                        tls = False
-                        if 'tls' in manifest_resource['spec']:
-                            for tls_config in manifest_resource['spec']['tls']:
-                                if ('hosts' in tls_config) and (host in tls_config['hosts']):
-                                    tls = True
-                                    break
-
-                        # determine protocol
-                        protocol = ''
-                        if tls:
-                            protocol = 'https://'
-                        else:
-                            protocol = 'http://'
-
-                        # record the host url
-                        host_urls.append(f"{protocol}{host}")
+    try:
+        with open(manifest_path, encoding='utf-8') as file:
+            # for each resource in the manfest,
+            # determine if its a known type and then get the host URLs from it
+            for manifest_resource in _load_host_resources(file):
+                get_host_urls = HOST_URL_RESOURCE_HANDLERS.get(
+                    (manifest_resource.get('kind'), manifest_resource.get('apiVersion'))
+                )
+                if get_host_urls:
+                    host_urls.extend(get_host_urls(manifest_resource))
+    except (OSError, UnicodeDecodeError, yaml.YAMLError) as error:
+        raise StepRunnerException(
+            f"Error reading deployed manifest ({manifest_path}): {error}"
+        ) from error
 
     return host_urls
 
 
 def _argocd_get_app_manifest(
-        self,
+        work_dir_path,
         argocd_app_name,
         source='live'
 ):
@@ -686,6 +1088,8 @@ def _argocd_get_app_manifest(
 
     Parameters
     ----------
+    work_dir_path : str
+        Working directory to write the manifest file to.
     argocd_app_name : str
         Name of the ArgoCD Application to get the manifest for.
     source : str (live,git)
@@ -701,16 +1105,20 @@ def _argocd_get_app_manifest(
     StepRunnerException
         If error getting ArgoCD manifest.
     """
-    argocd_app_manifest_file = self.write_working_file('deploy_argocd_manifests.yml')
+    argocd_app_manifest_file = write_working_file(work_dir_path, 'deploy_argocd_manifests.yml')
+    # sh opens the file and hands it to argocd as its stdout,
+    # so the manifest goes straight to disk without passing through Python
     try:
-        sh.argocd.app.manifests(  # pylint: disable=no-member
+        _argocd().app.manifests(  # pylint: disable=no-member
             f'--source={source}',
             argocd_app_name,
             _out=argocd_app_manifest_file,
             _err=sys.stderr
         )
     except sh.ErrorReturnCode as error:
-        raise f"Error reading ArgoCD Application ({argocd_app_name}) manifest: {error}"
+        raise StepRunnerException(
+            f"Error reading ArgoCD Application ({argocd_app_name}) manifest: {error}"
+        ) from error
 
     return argocd_app_manifest_file
 
@@ -727,8 +1135,8 @@ def deploy(git_password):  # pylint: disable=too-many-locals, too-many-statement
     deployment_config_destination_cluster_token = '' # self.get_value('kube-api-token')
     deployment_config_helm_chart_environment_values_file = 'values-DEV.yaml'
     deployment_config_helm_chart_values_file_container_image_address_yq_path = '.image.tag'
-    deployment_config_helm_chart_additional_value_files = ''
-    additional_helm_values_files = ''
+    deployment_config_helm_chart_additional_value_files = []
+    additional_helm_values_files = []
     argocd_app_name = 'tekton-task-app'
     container_image_address = 'myimage:newsha'
 
@@ -750,15 +1158,29 @@ def deploy(git_password):  # pylint: disable=too-many-locals, too-many-statement
     argocd_sync_retry_limit=20
     argocd_sync_prune=False
     work_dir_path = '.'
+    # git clone creates the directory itself
+    repo_dir = os.path.join(work_dir_path, 'deployment-config-repo')
 
     results['argocd-app-name'] = 'argocd_app_name'
     results['container-image-deployed-address'] = container_image_address
 
     try:
 
+        # sign into ArgoCD in the background while the configuration repository is updated,
+        # the two are independent of each other and both spend most of their time on the network
+        print("Sign into ArgoCD")
+        executor = ThreadPoolExecutor(max_workers=1)
+        argocd_sign_in_future = executor.submit(
+            _argocd_sign_in,
+            argocd_api=argocd_api,
+            username=argocd_username,
+            password=argocd_password,
+            insecure=argocd_skip_tls
+        )
+        executor.shutdown(wait=False)
+
         # clone the configuration repository
         print("Clone the configuration repository")
-        repo_dir = create_working_dir_sub_dir('.', 'deployment-config-repo')
         deployment_config_repo_dir = clone_repo(
             repo_dir= repo_dir,
             repo_url=deployment_config_repo,
@@ -766,59 +1188,65 @@ def deploy(git_password):  # pylint: disable=too-many-locals, too-many-statement
             git_email = git_email,
             git_name= git_name,
             username = git_username,
-            password = git_password
+            password = git_password,
+            sparse_checkout_dirs=[deployment_config_helm_chart_path]
         )
 
         # update values file, commit it, push it, and tag it
         print("Update the environment values file")
-        deployment_config_helm_chart_environment_values_file_path = os.path.join(
-            deployment_config_repo_dir,
+        deployment_config_helm_chart_environment_values_file_rel_path = os.path.join(
             deployment_config_helm_chart_path,
             deployment_config_helm_chart_environment_values_file
         )
-        _update_yaml_file_value(
-            work_dir_path = work_dir_path,
+        deployment_config_helm_chart_environment_values_file_path = os.path.join(
+            deployment_config_repo_dir,
+            deployment_config_helm_chart_environment_values_file_rel_path
+        )
+        values_file_updated = _update_yaml_file_value(
             file=deployment_config_helm_chart_environment_values_file_path,
             yq_path=deployment_config_helm_chart_values_file_container_image_address_yq_path,
             value=container_image_address
         )
 
-        print("Commit the updated environment values file")
-        _git_commit_file(
-            git_commit_message=f'Updating values for deployment to {environment}',
-            file_path=os.path.join(
-                deployment_config_helm_chart_path,
-                deployment_config_helm_chart_environment_values_file
-            ),
-            repo_dir=deployment_config_repo_dir
-        )
-        print("Push the updated environment values file")
         deployment_config_repo_tag = 'DO NOT USE'
-        _git_push_deployment_config_repo(
-            deployment_config_repo=deployment_config_repo,
-            deployment_config_repo_dir=deployment_config_repo_dir,
-            username=git_username,
-            password=git_password
-        )
+
+        # nothing to commit or push if the values file already has the value,
+        # but still sync to make sure the cluster matches the configuration repository
+        if values_file_updated:
+            print("Commit the updated environment values file")
+            _git_commit_file(
+                git_commit_message=f'Updating values for deployment to {environment}',
+                file_path=deployment_config_helm_chart_environment_values_file_rel_path,
+                repo_dir=deployment_config_repo_dir
+            )
+            print("Push the updated environment values file")
+            _git_push_deployment_config_repo(
+                deployment_config_repo=deployment_config_repo,
+                deployment_config_repo_dir=deployment_config_repo_dir,
+                branch=deployment_config_repo_branch,
+                username=git_username,
+                password=git_password
+            )
+        else:
+            print(
+                "Environment values file already has the container image address,"
+                " skip commit and push"
+            )
         # TODO: capture pushed commit hash in results
 
 
-        # create/update argocd app and sync it
-        print("Sign into ArgoCD")
-        _argocd_sign_in(
-            argocd_api=argocd_api,
-            username=argocd_username,
-            password=argocd_password,
-            insecure=argocd_skip_tls
-        )
+        # create/update argocd app and sync it,
+        # once the background sign in has finished (re-raising any error from it)
+        argocd_sign_in_future.result()
 
         print(f'Deploying to namespace: {deployment_namespace}')
 
         print(f"Create or update ArgoCD Application ({argocd_app_name})")
-        argocd_values_files = []
-        argocd_values_files += deployment_config_helm_chart_additional_value_files
-        argocd_values_files += [deployment_config_helm_chart_environment_values_file]
-        argocd_values_files += additional_helm_values_files
+        argocd_values_files = [
+            *deployment_config_helm_chart_additional_value_files,
+            deployment_config_helm_chart_environment_values_file,
+            *additional_helm_values_files
+        ]
         _argocd_app_create_or_update(
             argocd_app_name=argocd_app_name,
             repo=deployment_config_repo,
@@ -843,6 +1271,7 @@ def deploy(git_password):  # pylint: disable=too-many-locals, too-many-statement
         # get the ArgoCD app manifest that was synced
         print(f"Get ArgoCD Application ({argocd_app_name}) synced manifest")
         argocd_app_manifest_file = _argocd_get_app_manifest(
+            work_dir_path=work_dir_path,
             argocd_app_name=argocd_app_name
         )
         results['argocd-deployed-manifest'] = argocd_app_manifest_file
@@ -857,16 +1286,20 @@ def deploy(git_password):  # pylint: disable=too-many-locals, too-many-statement
         )
         results['deployed-host-urls'] = deployed_host_urls
 
-    except RuntimeError as error:
+    except StepRunnerException as error:
         results['success'] = False
         results['message'] = f"Error deploying to environment ({environment}):" \
                               f" {str(error)}"
+    finally:
+        # in case of an error before the push removed them
+        _remove_git_credentials(repo_dir)
 
     return results
 
 
 # Run the script
-task_results = deploy(
-    git_password = sys.argv[1]
-)
-print(task_results)
+if __name__ == '__main__':
+    task_results = deploy(
+        git_password = sys.argv[1]
+    )
+    print(task_results)
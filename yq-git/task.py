@@ -1,9 +1,188 @@
+import difflib
+import functools
 import os
 import re
 import sh
+import shlex
 import sys
+import tempfile
+import urllib.parse
+from io import StringIO
+
+try:
+    from ruamel.yaml import YAML, YAMLError
+    # round trip loader/dumper that keeps quoting and layout, and does not fold long lines
+    YAML_RT = YAML()
+    YAML_RT.preserve_quotes = True
+    YAML_RT.indent(mapping=2, sequence=4, offset=2)
+    YAML_RT.width = 4096
+except ImportError:
+    YAML_RT = None
+
+@functools.lru_cache(maxsize=None)
+def _git():
+    """git, resolved on PATH on first use rather than on import, run without a pseudo-terminal.
+    """
+    return sh.Command('git').bake(
+        # protocol v2 lists only the refs asked for
+        '-c', 'protocol.version=2',
+        _tty_out=False
+    )
+
+
+YQ_SIMPLE_PATH_REGEX = re.compile(r"^(\.[\w-]+)+$")
+# a document start marker (---), after any leading blank or comment lines
+YAML_EXPLICIT_START_REGEX = re.compile(r"^(?:[ \t]*(?:#.*)?\n)*---(?:\s|$)")
+# a key on its own line, then the first entry of the block sequence under it,
+# to tell how far the file indents the dash and the entry from the key
+YAML_BLOCK_SEQUENCE_INDENT_REGEX = re.compile(
+    r"^( *)[^\s#-][^\n]*:[ \t]*(?:#.*)?\n(?:[ \t]*(?:#.*)?\n)*( *)- +(?=\S)",
+    re.MULTILINE
+)
+# suffix of the credentials file for the git `store` helper
+GIT_CREDENTIALS_FILE_SUFFIX = '.git-credentials'
+
+
+# git credential helpers, keep in sync with their copies in argocd-deploy/argocd-deploy.py
+# (build.sh inlines this script into the Task, so it can not import them from a shared module)
+@functools.lru_cache(maxsize=None)
+def _git_credentials_dir():
+    """Private (0700) temporary directory for the git credentials file, on the pod's own
+    storage rather than next to the clone, where the workspace may be a persistent volume.
+    """
+    return tempfile.mkdtemp(prefix='git-credentials-')
+
+
+def _git_credentials_file_path(repo_dir):
+    return os.path.join(
+        _git_credentials_dir(),
+        os.path.basename(os.path.abspath(repo_dir)) + GIT_CREDENTIALS_FILE_SUFFIX
+    )
+
+
+def _git_credentials_command(repo_dir, repo_url, username, password):
+    """Returns the git command to run so that it uses the given username and
+    password for an http(s) git repository, by way of git's `store` credential helper
+    reading them from a file in a private temporary directory.
+
+    Keeps the credentials out of the repository URL, where they would otherwise end up in
+    the arguments of every git process, in git's output and in the clone's remote config.
+    The credential helper is configured with `-c` options of only the returned git command,
+    in place of any helpers from the git config files, which are left untouched.
+    Remove the file with `_remove_git_credentials` once done.
+
+    Returns
+    -------
+    sh.Command
+        Git command to run, or `_git()` as is if no credentials are given or the repository
+        is not accessed over http(s).
+    """
+    repo_url_parts = urllib.parse.urlsplit(repo_url)
+    if not (username and password and repo_url_parts.scheme in ('http', 'https')):
+        return _git()
+
+    # the store helper matches on protocol and host, quote the credentials so `@`/`:` stay in them
+    repo_host = repo_url_parts.netloc.rpartition('@')[2]
+    credentials_file_path = _git_credentials_file_path(repo_dir)
+    credentials_file_descriptor = os.open(
+        credentials_file_path,
+        os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+        0o600
+    )
+    with os.fdopen(credentials_file_descriptor, 'w', encoding='utf-8') as credentials_file:
+        credentials_file.write(
+            f"{repo_url_parts.scheme}://{urllib.parse.quote(username, safe='')}"
+            f":{urllib.parse.quote(password, safe='')}@{repo_host}\n"
+        )
+
+    # an empty credential.helper clears any configured before it, and never prompt for input
+    return _git().bake(
+        '-c', 'credential.helper=',
+        '-c', f'credential.helper=store --file={shlex.quote(credentials_file_path)}',
+        _env={**os.environ, 'GIT_TERMINAL_PROMPT': '0'}
+    )
+
+
+def _remove_git_credentials(repo_dir):
+    """Removes the file written by `_git_credentials_command` for the given repository directory,
+    if there is one.
+    """
+    try:
+        os.remove(_git_credentials_file_path(repo_dir))
+    except FileNotFoundError:
+        pass
+
+
+# clone helpers, keep in sync with their copies in argocd-deploy/argocd-deploy.py
+def _update_existing_clone(  # pylint: disable=too-many-arguments
+        git,
+        repo_dir,
+        repo_url,
+        repo_branch,
+        git_email,
+        git_name,
+        sparse_checkout_dirs=None
+):
+    """Updates an existing clone of the deployment configuration repository to the tip of
+    the given branch, fetching just that tip rather than cloning the repository again.
+
+    Returns
+    -------
+    str
+        Path to the directory of the updated clone.
+
+    Raises
+    ------
+    RuntimeError
+        If error updating the existing clone.
+    """
+    # update origin/<branch> too, or create the branch from the default branch if there is none
+    try:
+        try:
+            git.fetch(  # pylint: disable=no-member
+                '--depth=1',
+                '--no-tags',
+                repo_url,
+                f'+refs/heads/{repo_branch}:refs/remotes/origin/{repo_branch}',
+                _cwd=repo_dir,
+                _out=sys.stdout
+            )
+            checkout_flags = ['-B', repo_branch, f'refs/remotes/origin/{repo_branch}']
+        except sh.ErrorReturnCode as error:
+            if b"couldn't find remote ref" not in error.stderr:
+                raise
+            git.fetch(  # pylint: disable=no-member
+                '--depth=1',
+                '--no-tags',
+                repo_url,
+                'HEAD',
+                _cwd=repo_dir,
+                _fg=True
+            )
+            checkout_flags = ['--no-track', '-B', repo_branch, 'FETCH_HEAD']
 
-GIT_REPO_REGEX = re.compile(r"(?P<protocol>^https:\/\/|^http:\/\/)?(?P<address>.*$)")
+        if sparse_checkout_dirs is not None:
+            git(  # pylint: disable=not-callable
+                'sparse-checkout', 'set', '--cone',
+                *[sparse_dir for sparse_dir in sparse_checkout_dirs if sparse_dir],
+                _cwd=repo_dir,
+                _fg=True
+            )
+        git.checkout(  # pylint: disable=no-member
+            '--force',
+            *checkout_flags,
+            _cwd=repo_dir,
+            _fg=True
+        )
+        git.config('user.email', git_email, _cwd=repo_dir)  # pylint: disable=no-member
+        git.config('user.name', git_name, _cwd=repo_dir)  # pylint: disable=no-member
+    except sh.ErrorReturnCode as error:
+        raise RuntimeError(
+            f"Error updating existing clone of repository ({repo_url})"
+            f" in directory ({repo_dir}): {error}"
+        ) from error
+
+    return repo_dir
 
 
 def clone_repo(  # pylint: disable=too-many-arguments
@@ -13,7 +192,8 @@ def clone_repo(  # pylint: disable=too-many-arguments
         git_email,
         git_name,
         username=None,
-        password=None
+        password=None,
+        sparse_checkout_dirs=None
 ):
     """Clones and checks out the deployment configuration repository.
 
@@ -27,6 +207,10 @@ def clone_repo(  # pylint: disable=too-many-arguments
         email to use when performing git operations in the cloned repository
     git_name : str
         name to use when performing git operations in the cloned repository
+    sparse_checkout_dirs : list of str, optional
+        Directories of the repository to check out, relative to its root, along with the
+        files in its root. If not given the whole repository is checked out.
+        Needs git 2.35 or later, for `git sparse-checkout set --cone`.
 
     Returns
     -------
@@ -39,84 +223,227 @@ def clone_repo(  # pylint: disable=too-many-arguments
     RuntimeError
     * if error cloning repository
     * if error checking out branch of repository
-    * if error configuring repo user
     """
-    repo_match = GIT_REPO_REGEX.match(repo_url)
-    repo_protocol = repo_match.groupdict()['protocol']
-    repo_address = repo_match.groupdict()['address']
-    # if deployment config repo uses http/https push using user/pass
-    # else push using ssh
-    if username and password and repo_protocol and re.match(
-            r'^http://|^https://',
-            repo_protocol
-    ):
-        repo_url_with_auth = \
-            f"{repo_protocol}{username}:{password}" \
-            f"@{repo_address}"
-    else:
-        repo_url_with_auth = repo_url
+    # if deployment config repo uses http/https clone using user/pass
+    # else clone using ssh
+    git = _git_credentials_command(repo_dir, repo_url, username, password)
+
+    if os.path.isdir(os.path.join(repo_dir, '.git')):
+        # reuse the clone left in repo_dir by a previous run (eg: on a persistent workspace)
+        return _update_existing_clone(
+            git=git,
+            repo_dir=repo_dir,
+            repo_url=repo_url,
+            repo_branch=repo_branch,
+            git_email=git_email,
+            git_name=git_name,
+            sparse_checkout_dirs=sparse_checkout_dirs
+        )
+
+    # clone just the tip of the branch, or of the default branch if the branch is new
     try:
-        sh.git.clone(
-            repo_url_with_auth,
-            repo_dir,
-            _out=sys.stdout,
+        remote_branch_exists = bool(str(git(  # pylint: disable=not-callable
+            'ls-remote',
+            '--heads',
+            repo_url,
+            f'refs/heads/{repo_branch}',
             _err=sys.stderr
+        )).strip())
+    except sh.ErrorReturnCode as error:
+        raise RuntimeError(
+            f"Error listing branches of repository ({repo_url}): {error}"
+        ) from error
+
+    clone_flags = ['--depth=1', '--single-branch', '--no-tags']
+    if remote_branch_exists:
+        clone_flags += ['--branch', repo_branch]
+    if sparse_checkout_dirs is not None:
+        # fetch only the blobs that are checked out, once the sparse checkout is configured
+        clone_flags += ['--filter=blob:none', '--no-checkout', '--sparse']
+
+    try:
+        git.clone(  # pylint: disable=no-member
+            *clone_flags,
+            # set the commit identity as part of the clone
+            '--config', f'user.email={git_email}',
+            '--config', f'user.name={git_name}',
+            repo_url,
+            repo_dir,
+            # git writes its progress straight to the inherited stdout/stderr
+            _fg=True
         )
     except sh.ErrorReturnCode as error:
         raise RuntimeError(f"Error cloning repository ({repo_url}): {error}") from error
 
-    try:
-        # no atomic way in git to checkout out new or existing branch,
-        # so first try to check out existing, if that doesn't work try new
+    if sparse_checkout_dirs is not None:
         try:
-            sh.git.checkout(  # pylint: disable=no-member
-                repo_branch,
+            git(  # pylint: disable=not-callable
+                'sparse-checkout', 'set', '--cone',
+                *[sparse_dir for sparse_dir in sparse_checkout_dirs if sparse_dir],
                 _cwd=repo_dir,
-                _out=sys.stdout,
-                _err=sys.stderr
+                _fg=True
             )
-        except sh.ErrorReturnCode:
-            sh.git.checkout(
+            # unlike `checkout -b`, this also populates the so far empty working tree
+            git.checkout(  # pylint: disable=no-member
+                '-B', repo_branch,
+                'HEAD',
+                _cwd=repo_dir,
+                _fg=True
+            )
+        except sh.ErrorReturnCode as error:
+            raise RuntimeError(
+                f"Error checking out ({sparse_checkout_dirs}) of branch ({repo_branch})"
+                f" from repository ({repo_url}): {error}"
+            ) from error
+    elif not remote_branch_exists:
+        try:
+            git.checkout(  # pylint: disable=no-member
                 '-b',
                 repo_branch,
                 _cwd=repo_dir,
-                _out=sys.stdout,
-                _err=sys.stderr
+                _fg=True
             )
-    except sh.ErrorReturnCode as error:
-        # NOTE: this should never happen
-        raise RuntimeError(
-            f"Unexpected error checking out new or existing branch ({repo_branch}) from repository ({repo_url}): {error}"
-        ) from error
+        except sh.ErrorReturnCode as error:
+            # NOTE: this should never happen
+            raise RuntimeError(
+                f"Unexpected error checking out new branch ({repo_branch}) from repository ({repo_url}): {error}"
+            ) from error
+
+    return repo_dir
+
 
+# YAML update and git commit/push helpers, keep in sync with argocd-deploy/argocd-deploy.py
+def _yaml_round_trip_only_changed_target(original_yaml, updated_yaml):
+    """Whether re-dumping a YAML document changed (or removed) at most one of its original lines,
+    any number of lines may be added.
+    """
+    # keep the line endings, so that a line whose ending changed counts as changed
+    original_lines = original_yaml.splitlines(keepends=True)
+    updated_lines = updated_yaml.splitlines(keepends=True)
+    changed_original_line_count = sum(
+        original_end - original_start
+        for tag, original_start, original_end, _, _ in difflib.SequenceMatcher(
+            None, original_lines, updated_lines, autojunk=False
+        ).get_opcodes()
+        if tag in ('replace', 'delete')
+    )
+    return changed_original_line_count <= 1
+
+
+def _read_yaml_file(file):
+    """Reads the contents of a YAML file, as bytes.
+
+    Raises
+    ------
+    RuntimeError
+        If error reading file.
+    """
     try:
-        sh.git.config(  # pylint: disable=no-member
-            'user.email',
-            git_email,
-            _cwd=repo_dir,
-            _out=sys.stdout,
-            _err=sys.stderr
-        )
-        sh.git.config(  # pylint: disable=no-member
-            'user.name',
-            git_name,
-            _cwd=repo_dir,
-            _out=sys.stdout,
-            _err=sys.stderr
-        )
-    except sh.ErrorReturnCode as error:
-        # NOTE: this should never happen
-        raise RuntimeError(
-            f"Unexpected error configuring git user.email ({git_email})"
-            f" and user.name ({git_name}) for repository ({repo_url})"
-            f" in directory ({repo_dir}): {error}"
-        ) from error
+        with open(file, 'rb') as stream:
+            return stream.read()
+    except OSError as error:
+        raise RuntimeError(f"Error reading YAML file ({file}): {error}") from error
 
-    return repo_dir
 
+def _yaml_block_sequence_indent(yaml_str):
+    """Guesses the block sequence indentation of a YAML document, as ruamel.yaml `indent`
+    arguments, defaulting to indented sequences if the document has no block sequences.
+    """
+    match = YAML_BLOCK_SEQUENCE_INDENT_REGEX.search(yaml_str)
+    if match is None:
+        return {'sequence': 4, 'offset': 2}
+
+    key_indent = len(match.group(1))
+    return {
+        'sequence': match.end() - match.start(2) - key_indent,
+        'offset': len(match.group(2)) - key_indent
+    }
+
+
+def _yaml_round_trip_dump(data, original_yaml):
+    """Dumps YAML loaded from `original_yaml` back out, in the same layout and line endings.
+    """
+    # ruamel.yaml is given, and dumps, \n line endings, any CRLF ones are put back after
+    lf_yaml = original_yaml.replace('\r\n', '\n')
+    YAML_RT.explicit_start = YAML_EXPLICIT_START_REGEX.match(lf_yaml) is not None
+    YAML_RT.indent(mapping=2, **_yaml_block_sequence_indent(lf_yaml))
+    updated_yaml_stream = StringIO()
+    YAML_RT.dump(data, updated_yaml_stream)
+    updated_yaml = updated_yaml_stream.getvalue()
+    if not lf_yaml.endswith('\n'):
+        updated_yaml = updated_yaml.rstrip('\n')
+    if lf_yaml != original_yaml:
+        updated_yaml = updated_yaml.replace('\n', '\r\n')
+    return updated_yaml
+
+
+def _update_yaml_file_value(file, yq_path, value):
+    """Update a YAML file value, in process where possible, else using YQ.
+
+    Parameters
+    ----------
+    file : str
+        Path to file to update.
+    yq_path : str
+        YQ path to the value to update.
+    value: str
+        value to update the `yq_path`
+
+    Returns
+    -------
+    bool
+        False if the value was already set to `value` and so the file was left as is,
+        True otherwise.
+
+    Raises
+    ------
+    RuntimeError
+        If error updating file.
+    """
+    original_contents = _read_yaml_file(file)
 
-def _update_yaml_file_value(work_dir_path, file, yq_path, value):
-    # Use the yq command to update the file
+    # update simple paths (eg: .image.tag) in process, else fall back to yq
+    if YAML_RT is not None and YQ_SIMPLE_PATH_REGEX.match(yq_path):
+        try:
+            original_yaml = original_contents.decode('utf-8')
+        except UnicodeDecodeError as error:
+            raise RuntimeError(f"Error reading YAML file ({file}): {error}") from error
+        try:
+            data = YAML_RT.load(original_yaml.replace('\r\n', '\n'))
+        except YAMLError:
+            # eg: more than one document in the file, leave it to yq
+            data = None
+
+        *parent_keys, leaf_key = yq_path[1:].split('.')
+        parent = data
+        for key in parent_keys:
+            if not isinstance(parent, dict):
+                break
+            # create missing (or empty) parent mappings, as `yq '.a.b = "c"'` does
+            if parent.get(key) is None:
+                parent[key] = type(parent)()
+            parent = parent[key]
+
+        if isinstance(parent, dict):
+            if parent.get(leaf_key) == value:
+                return False
+
+            parent[leaf_key] = value
+            updated_yaml = _yaml_round_trip_dump(data, original_yaml)
+
+            # leave it to yq if the round trip re-formatted anything but the target line
+            if _yaml_round_trip_only_changed_target(original_yaml, updated_yaml):
+                try:
+                    with open(file, 'w', encoding='utf-8', newline='') as stream:
+                        stream.write(updated_yaml)
+                except OSError as error:
+                    raise RuntimeError(
+                        f"Error writing YAML file ({file}): {error}"
+                    ) from error
+                return True
+
+    # Use the yq command to update the file,
+    # comparing the contents either side of it to tell whether anything changed
     try:
         sh.yq.eval(  # pylint: disable=no-member
             f'{yq_path} = "{value}"',
@@ -129,32 +456,18 @@ def _update_yaml_file_value(work_dir_path, file, yq_path, value):
             f" {error}"
         ) from error
 
-    return file
+    return _read_yaml_file(file) != original_contents
 
 
 def _git_commit_file(git_commit_message, file_path, repo_dir):
     try:
-        sh.git.add(  # pylint: disable=no-member
-            file_path,
-            _cwd=repo_dir,
-            _out=sys.stdout,
-            _err=sys.stderr
-        )
-    except sh.ErrorReturnCode as error:
-        # NOTE: this should never happen
-        raise RuntimeError(
-            f"Unexpected error adding file ({file_path}) to commit"
-            f" in git repository ({repo_dir}): {error}"
-        ) from error
-
-    try:
-        sh.git.commit(  # pylint: disable=no-member
-            '--allow-empty',
-            '--all',
+        _git().commit(  # pylint: disable=no-member
             '--message', git_commit_message,
+            # giving the path stages it, so no separate `git add` is needed
+            '--',
+            file_path,
             _cwd=repo_dir,
-            _out=sys.stdout,
-            _err=sys.stderr
+            _fg=True
         )
     except sh.ErrorReturnCode as error:
         # NOTE: this should never happen
@@ -164,18 +477,30 @@ def _git_commit_file(git_commit_message, file_path, repo_dir):
         ) from error
 
 
-def _git_push(repo_dir, url=None):
+def _git_push(repo_dir, branch, url=None, git=None):
     """
-    Raises string if error pushing commits
+    Raises RuntimeError if error pushing commits
     """
 
-    git_push = sh.git.push.bake(url) if url else sh.git.push
-
-    # push commits
+    # push only the given branch using an explicit refspec, so that git does not need to
+    # work out what to push from push.default and upstream tracking configuration,
+    # which also covers branches that were created locally and do not exist upstream yet.
+    # the push is of a generated commit, so don't run any pre-push hook left in a reused clone
     try:
-        git_push(
+        (git or _git()).push(  # pylint: disable=no-member
+            '--no-verify',
+            url or 'origin',
+            f'HEAD:refs/heads/{branch}',
             _cwd=repo_dir,
-            _out=sys.stdout
+            _fg=True
+        )
+        # pushing by URL leaves origin/<branch> as it was, so move it to what was just pushed,
+        # else a reused clone would report the branch as ahead of it until the next fetch
+        (git or _git())(  # pylint: disable=not-callable
+            'update-ref',
+            f'refs/remotes/origin/{branch}',
+            'HEAD',
+            _cwd=repo_dir
         )
     except sh.ErrorReturnCode as error:
         raise RuntimeError(
@@ -187,30 +512,55 @@ def _git_push(repo_dir, url=None):
 def _git_push_repo(
         repo,
         repo_dir,
+        branch,
         username,
         password
 ):
-    deployment_config_repo_match = GIT_REPO_REGEX.match(repo)
-    deployment_config_repo_protocol = deployment_config_repo_match.groupdict()['protocol']
-    deployment_config_repo_address = deployment_config_repo_match.groupdict()['address']
-
     # if deployment config repo uses http/https push using user/pass
     # else push using ssh
-    if deployment_config_repo_protocol and re.match(
-            r'^http://|^https://',
-            deployment_config_repo_protocol
-    ):
-        deployment_config_repo_with_user_pass = \
-            f"{deployment_config_repo_protocol}{username}:{password}" \
-            f"@{deployment_config_repo_address}"
+    # remove the credentials once pushed
+    try:
         _git_push(
             repo_dir=repo_dir,
-            url=deployment_config_repo_with_user_pass
-        )
-    else:
-        _git_push(
-            repo_dir=repo_dir
+            branch=branch,
+            url=repo,
+            git=_git_credentials_command(repo_dir, repo, username, password)
         )
+    finally:
+        _remove_git_credentials(repo_dir)
+
+
+def _update_and_commit_yaml_file_value(repo_dir, file, yq_path, value):
+    """Updates a YAML file value in the cloned repository and commits it.
+
+    Returns
+    -------
+    bool
+        False if the value was already set to `value` and so there was nothing to commit,
+        True otherwise.
+
+    Raises
+    ------
+    RuntimeError
+        If error updating or committing file.
+    """
+    print("Update the environment values file")
+    values_file_updated = _update_yaml_file_value(
+        file=os.path.join(repo_dir, file),
+        yq_path=yq_path,
+        value=value
+    )
+    if not values_file_updated:
+        print(f"Value at ({yq_path}) is already ({value}), nothing to commit or push")
+        return False
+
+    print("Commit the updated environment values file")
+    _git_commit_file(
+        git_commit_message='Updating values for deployment',
+        file_path=file,
+        repo_dir=repo_dir
+    )
+    return True
 
 
 def update_yaml_in_repo(
@@ -226,60 +576,58 @@ def update_yaml_in_repo(
 ):
     results = {}
     work_dir_path = '.'
+    # git clone creates the directory itself
+    repo_dir = os.path.join(work_dir_path, 'deployment-config-repo')
 
     try:
 
         # clone the configuration repository
         print("Clone the configuration repository")
-        repo_dir = os.path.join(work_dir_path, 'deployment-config-repo')
-        os.makedirs(repo_dir, exist_ok=True)
         deployment_config_repo_dir = clone_repo(
             repo_dir=repo_dir,
             repo_url=repo,
             repo_branch=branch,
             git_email=git_email,
-            git_name=git_name #,
+            git_name=git_name,
+            sparse_checkout_dirs=[os.path.dirname(file)] #,
             # username=git_username,
             # password=git_password
         )
 
         # update values file, commit it, push it, and tag it
-        print("Update the environment values file")
-        deployment_config_helm_chart_environment_values_file_path = os.path.join(
-            deployment_config_repo_dir,
-            file
-        )
-        _update_yaml_file_value(
-            work_dir_path=work_dir_path,
-            file=deployment_config_helm_chart_environment_values_file_path,
-            yq_path=yq_path,
-            value=new_value
-        )
+        if not _update_and_commit_yaml_file_value(
+                repo_dir=deployment_config_repo_dir,
+                file=file,
+                yq_path=yq_path,
+                value=new_value
+        ):
+            results['success'] = True
+            return results
 
-        print("Commit the updated environment values file")
-        _git_commit_file(
-            git_commit_message=f'Updating values for deployment',
-            file_path=file,
-            repo_dir=deployment_config_repo_dir
-        )
         print("Push the updated environment values file")
         _git_push_repo(
             repo=repo,
             repo_dir=deployment_config_repo_dir,
+            branch=branch,
             username=git_username,
             password=git_password
         )
         # TODO: capture pushed commit hash in results
 
+        results['success'] = True
     except RuntimeError as error:
         results['success'] = False
         results['message'] = f"Error updating gitops repository {str(error)}"
+    finally:
+        # in case of an error before the push removed them
+        _remove_git_credentials(repo_dir)
 
     return results
 
 
 # Run the script
-task_results = update_yaml_in_repo(
+if __name__ == '__main__':
+    task_results = update_yaml_in_repo(
         file='charts/reference-quarkus-mvn-deploy/values-DEV.yaml',
         new_value=os.environ.get('NEW_VALUE'),
         git_password=os.environ.get('GIT_PASSWORD'),
@@ -289,9 +637,9 @@ task_results = update_yaml_in_repo(
         repo='https://github.com/dwinchell-robot/reference-quarkus-mvn-cloud-resources_tekton_workflow-minimal.git',
         branch='main',
         yq_path='.image.tag',
-)
+    )
 
-print(task_results)
+    print(task_results)
 
-if task_results['success'] == False:
-    sys.exit(1)
+    if task_results['success'] == False:
+        sys.exit(1)